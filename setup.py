@@ -36,7 +36,7 @@ setup(
     use_scm_version=True,
     setup_requires=["setuptools_scm"],
     install_requires=[
-        "Twisted>=19.2.1",
+        "Twisted>=21.2.0",
         "prometheus_client>=0.7.0,<0.8",
         "aioapns>=1.7",
         "cryptography>=2.1.4",
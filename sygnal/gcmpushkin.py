@@ -14,24 +14,31 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import json
 import logging
 import time
-from io import BytesIO
-from json import JSONDecodeError
+from collections import OrderedDict
 
 from opentracing import logs, tags
 from prometheus_client import Counter, Gauge, Histogram
-from twisted.internet.defer import DeferredSemaphore
-from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.internet.defer import Deferred, DeferredQueue, ensureDeferred, succeed
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
 from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
+from zope.interface import implementer
 
 from sygnal.exceptions import (
     NotificationDispatchException,
     TemporaryNotificationDispatchException,
 )
 from sygnal.helper.context_factory import ClientTLSOptionsFactory
-from sygnal.utils import NotificationLoggerAdapter, twisted_sleep
+from sygnal.utils import (
+    NotificationLoggerAdapter,
+    json_dumps,
+    json_loads,
+    twisted_sleep,
+)
 
 from .exceptions import PushkinSetupException
 from .notifications import Pushkin
@@ -65,26 +72,102 @@ MAX_TRIES = 3
 RETRY_DELAY_BASE = 10
 MAX_BYTES_PER_FIELD = 1024
 
+# The number of bytes of an error response body to keep for logging;
+# anything beyond this is discarded.
+MAX_ERROR_BODY_LENGTH = 4096
+
 # The error codes that mean a registration ID will never
 # succeed and we should reject it upstream.
 # We include NotRegistered here too for good measure, even
 # though gcm-client 'helpfully' extracts these into a separate
 # list.
-BAD_PUSHKEY_FAILURE_CODES = [
-    "MissingRegistration",
-    "InvalidRegistration",
-    "NotRegistered",
-    "InvalidPackageName",
-    "MismatchSenderId",
-]
+BAD_PUSHKEY_FAILURE_CODES = frozenset(
+    {
+        "MissingRegistration",
+        "InvalidRegistration",
+        "NotRegistered",
+        "InvalidPackageName",
+        "MismatchSenderId",
+    }
+)
 
 # Failure codes that mean the message in question will never
 # succeed, so don't retry, but the registration ID is fine
 # so we should not reject it upstream.
-BAD_MESSAGE_FAILURE_CODES = ["MessageTooBig", "InvalidDataKey", "InvalidTtl"]
+BAD_MESSAGE_FAILURE_CODES = frozenset({"MessageTooBig", "InvalidDataKey", "InvalidTtl"})
 
 DEFAULT_MAX_CONNECTIONS = 20
 
+# The notification attributes that are copied into the GCM data payload.
+DATA_ATTRIBUTES = (
+    "event_id",
+    "type",
+    "sender",
+    "room_name",
+    "room_alias",
+    "membership",
+    "sender_display_name",
+    "content",
+    "room_id",
+)
+
+
+@implementer(IBodyProducer)
+class _BytesBodyProducer(object):
+    """
+    Writes a pre-encoded bytes body straight to the consumer, avoiding the
+    BytesIO wrapper and cooperative chunked-read loop that
+    L{FileBodyProducer} would use for a body that is already in memory.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer):
+        consumer.write(self.body)
+        return succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+class _BodyReader(Protocol):
+    """
+    Collects a response body, streaming incoming chunks into a single
+    growable buffer as they arrive. A lighter-weight replacement for
+    L{twisted.web.client.readBody}, which gathers chunks into a list that
+    is joined at the end and sets up cancellation machinery we never use.
+
+    If `max_length` is given, only that many bytes are kept; the rest of
+    the body is still drained (rather than aborting the connection) so
+    that it can be reused for keep-alive.
+    """
+
+    def __init__(self, deferred, max_length=None):
+        self._deferred = deferred
+        self._max_length = max_length
+        self._buffer = bytearray()
+
+    def dataReceived(self, data):
+        if self._max_length is not None:
+            remaining = self._max_length - len(self._buffer)
+            if len(data) > remaining:
+                data = data[:remaining]
+        self._buffer.extend(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone):
+            self._deferred.callback(bytes(self._buffer))
+        else:
+            self._deferred.errback(reason)
+
 
 class GcmPushkin(Pushkin):
     """
@@ -107,11 +190,27 @@ class GcmPushkin(Pushkin):
         self.max_connections = self.get_config(
             "max_connections", DEFAULT_MAX_CONNECTIONS
         )
-        self.connection_semaphore = DeferredSemaphore(self.max_connections)
+        # a fixed pool of workers consuming from a queue limits the number
+        # of concurrent requests: the HTTPConnectionPool would just create
+        # more (unpooled) connections rather than limiting, and a shared
+        # DeferredSemaphore pays an O(waiters) wake-up on every release.
+        # Each worker owns one connection slot.
+        self._request_queue = DeferredQueue()
+        for _ in range(self.max_connections):
+            ensureDeferred(self._request_worker())
+        # be explicit about keep-alive: reusing connections to FCM avoids a
+        # TCP + TLS handshake per notification, which dominates dispatch
+        # latency. Cache idle connections for 4 minutes to match FCM's
+        # server-side keep-alive window.
+        self.http_pool.persistent = True
+        self.http_pool.cachedConnectionTimeout = 240
         self.http_pool.maxPersistentPerHost = self.max_connections
 
         tls_client_options_factory = ClientTLSOptionsFactory()
 
+        # Twisted's Agent only speaks HTTP/1.1, so concurrency towards FCM
+        # comes from a pool of persistent connections rather than HTTP/2
+        # stream multiplexing over a single one.
         self.http_agent = Agent(
             reactor=sygnal.reactor,
             pool=self.http_pool,
@@ -125,6 +224,16 @@ class GcmPushkin(Pushkin):
         if not self.api_key:
             raise PushkinSetupException("No API key set in config")
 
+        # the request headers are identical for every request this pushkin
+        # makes, so build the Headers object once.
+        self._request_headers = Headers(
+            {
+                b"User-Agent": [b"sygnal"],
+                b"Content-Type": [b"application/json"],
+                b"Authorization": [b"key=" + self.api_key.encode()],
+            }
+        )
+
     @classmethod
     async def create(cls, name, sygnal, config):
         """
@@ -142,56 +251,98 @@ class GcmPushkin(Pushkin):
 
         return cls(name, sygnal, config, canonical_reg_id_store)
 
-    async def _perform_http_request(self, body, headers):
+    async def _request_worker(self):
+        """
+        Consumes requests from the queue and performs them, one at a time.
+        A fixed number of these run concurrently, which is what actually
+        limits the number of in-flight requests to FCM.
         """
-        Perform an HTTP request to the FCM server with the body and headers
-        specified.
+        while True:
+            queued_at, body, result_deferred = await self._request_queue.get()
+            PENDING_REQUESTS_GAUGE.dec()
+            QUEUE_TIME_HISTOGRAM.observe(time.monotonic() - queued_at)
+            try:
+                result = await self._send_http_request(body)
+            except Exception:
+                result_deferred.errback(Failure())
+            else:
+                result_deferred.callback(result)
+
+    async def _perform_http_request(self, body):
+        """
+        Perform an HTTP request to the FCM server with the body specified,
+        queueing it for one of the request workers.
         Args:
-            body (nested dict): Body. Will be JSON-encoded.
-            headers (Headers): HTTP Headers.
+            body (bytes): JSON-encoded request body.
 
         Returns:
 
         """
-        body_producer = FileBodyProducer(BytesIO(json.dumps(body).encode()))
+        result_deferred = Deferred()
+        PENDING_REQUESTS_GAUGE.inc()
+        self._request_queue.put((time.monotonic(), body, result_deferred))
+        return await result_deferred
+
+    async def _send_http_request(self, body):
+        """
+        Actually performs one HTTP request to the FCM server.
+        Args:
+            body (bytes): JSON-encoded request body.
 
-        # we use the semaphore to actually limit the number of concurrent
-        # requests, since the HTTPConnectionPool will actually just lead to more
-        # requests being created but not pooled – it does not perform limiting.
-        with QUEUE_TIME_HISTOGRAM.time():
-            with PENDING_REQUESTS_GAUGE.track_inprogress():
-                await self.connection_semaphore.acquire()
+        Returns:
+
+        """
+        body_producer = _BytesBodyProducer(body)
 
+        # a pair of monotonic clock reads replaces the Timer object that
+        # Histogram.time() would allocate per request (and is immune to
+        # wall-clock jumps).
+        send_start_time = time.monotonic()
         try:
-            with SEND_TIME_HISTOGRAM.time():
-                with ACTIVE_REQUESTS_GAUGE.track_inprogress():
-                    response = await self.http_agent.request(
-                        b"POST",
-                        GCM_URL,
-                        headers=Headers(headers),
-                        bodyProducer=body_producer,
-                    )
-                    response_text = (await readBody(response)).decode()
+            with ACTIVE_REQUESTS_GAUGE.track_inprogress():
+                response = await self.http_agent.request(
+                    b"POST",
+                    GCM_URL,
+                    headers=self._request_headers,
+                    bodyProducer=body_producer,
+                )
+                # only 2xx responses carry a body we parse; 400/401
+                # bodies are kept (capped) purely for the error logs,
+                # and everything else — notably the 5xx pages FCM
+                # serves during outages, which arrive exactly when we
+                # are busiest — is discarded without buffering.
+                if 200 <= response.code < 300:
+                    max_length = None
+                elif response.code in (400, 401):
+                    max_length = MAX_ERROR_BODY_LENGTH
+                else:
+                    max_length = 0
+
+                # the body is kept as bytes; it is only decoded into a
+                # str on the (cold) error-logging paths.
+                body_deferred = Deferred()
+                response.deliverBody(_BodyReader(body_deferred, max_length))
+                response_body = await body_deferred
         except Exception as exception:
             raise TemporaryNotificationDispatchException(
                 "GCM request failure"
             ) from exception
         finally:
-            self.connection_semaphore.release()
-        return response, response_text
+            SEND_TIME_HISTOGRAM.observe(time.monotonic() - send_start_time)
+        return response, response_body
 
-    async def _request_dispatch(self, n, log, body, headers, pushkeys, span):
-        poke_start_time = time.time()
+    async def _request_dispatch(self, n, log, body, pushkeys, span):
+        poke_start_time = time.monotonic()
 
         failed = []
 
-        response, response_text = await self._perform_http_request(body, headers)
+        response, response_body = await self._perform_http_request(body)
 
         RESPONSE_STATUS_CODES_COUNTER.labels(
             pushkin=self.name, code=response.code
         ).inc()
 
-        log.debug("GCM request took %f seconds", time.time() - poke_start_time)
+        log.debug("GCM request took %f seconds", time.monotonic() - poke_start_time)
 
         span.set_tag(tags.HTTP_STATUS_CODE, response.code)
 
@@ -213,13 +364,14 @@ class GcmPushkin(Pushkin):
             log.error(
                 "%d from server, we have sent something invalid! Error: %r",
                 response.code,
-                response_text,
+                response_body.decode("utf-8", "replace"),
             )
             # permanent failure: give up
             raise NotificationDispatchException("Invalid request")
         elif response.code == 401:
             log.error(
-                "401 from server! Our API key is invalid? Error: %r", response_text
+                "401 from server! Our API key is invalid? Error: %r",
+                response_body.decode("utf-8", "replace"),
             )
             # permanent failure: give up
             raise NotificationDispatchException("Not authorised to push")
@@ -229,14 +381,14 @@ class GcmPushkin(Pushkin):
             return pushkeys, []
         elif 200 <= response.code < 300:
             try:
-                resp_object = json.loads(response_text)
-            except JSONDecodeError:
+                resp_object = json_loads(response_body)
+            except ValueError:
                 raise NotificationDispatchException("Invalid JSON response from GCM.")
             if "results" not in resp_object:
                 log.error(
                     "%d from server but response contained no 'results' key: %r",
                     response.code,
-                    response_text,
+                    response_body.decode("utf-8", "replace"),
                 )
             if len(resp_object["results"]) < len(pushkeys):
                 log.error(
@@ -254,38 +406,41 @@ class GcmPushkin(Pushkin):
 
             # determine which pushkeys to retry or forget about
             new_pushkeys = []
-            for i, result in enumerate(resp_object["results"]):
+            new_canonical_ids = []
+            for pushkey, result in zip(pushkeys, resp_object["results"]):
                 span.set_tag("gcm_regid_updated", "registration_id" in result)
                 if "registration_id" in result:
-                    await self.canonical_reg_id_store.set_canonical_id(
-                        pushkeys[i], result["registration_id"]
-                    )
+                    new_canonical_ids.append((pushkey, result["registration_id"]))
                 if "error" in result:
-                    log.warning(
-                        "Error for pushkey %s: %s", pushkeys[i], result["error"]
-                    )
+                    log.warning("Error for pushkey %s: %s", pushkey, result["error"])
                     span.set_tag("gcm_error", result["error"])
                     if result["error"] in BAD_PUSHKEY_FAILURE_CODES:
                         log.info(
                             "Reg ID %r has permanently failed with code %r: "
                             "rejecting upstream",
-                            pushkeys[i],
+                            pushkey,
                             result["error"],
                         )
-                        failed.append(pushkeys[i])
+                        failed.append(pushkey)
                     elif result["error"] in BAD_MESSAGE_FAILURE_CODES:
                         log.info(
                             "Message for reg ID %r has permanently failed with code %r",
-                            pushkeys[i],
+                            pushkey,
                             result["error"],
                         )
                     else:
                         log.info(
                             "Reg ID %r has temporarily failed with code %r",
-                            pushkeys[i],
+                            pushkey,
                             result["error"],
                         )
-                        new_pushkeys.append(pushkeys[i])
+                        new_pushkeys.append(pushkey)
+
+            # store all the remapped registration IDs in one round-trip
+            # rather than one write per remapped device.
+            if new_canonical_ids:
+                await self.canonical_reg_id_store.set_canonical_ids(new_canonical_ids)
+
             return failed, new_pushkeys
         else:
             raise NotificationDispatchException(
@@ -293,17 +448,23 @@ class GcmPushkin(Pushkin):
             )
 
     async def dispatch_notification(self, n, device, context):
-        log = NotificationLoggerAdapter(logger, {"request_id": context.request_id})
-
-        pushkeys = [
-            device.pushkey for device in n.devices if device.app_id == self.name
-        ]
-        # Resolve canonical IDs for all pushkeys
+        # Kept for compatibility with callers that dispatch device by
+        # device: the first device of ours triggers a batch send to all of
+        # them, and the others are no-ops.
+        devices = [d for d in n.devices if d.app_id == self.name]
 
-        if pushkeys[0] != device.pushkey:
+        if devices[0].pushkey != device.pushkey:
             # Only send notifications once, to all devices at once.
             return []
 
+        return await self.dispatch_notification_batch(n, devices, context)
+
+    async def dispatch_notification_batch(self, n, devices, context):
+        log = NotificationLoggerAdapter(logger, {"request_id": context.request_id})
+
+        pushkeys = [device.pushkey for device in devices]
+        # Resolve canonical IDs for all pushkeys
+
         # The pushkey is kind of secret because you can use it to send push
         # to someone.
         # span_tags = {"pushkeys": pushkeys}
@@ -312,42 +473,67 @@ class GcmPushkin(Pushkin):
         with self.sygnal.tracer.start_span(
             "gcm_dispatch", tags=span_tags, child_of=context.opentracing_span
         ) as span_parent:
-            reg_id_mappings = await self.canonical_reg_id_store.get_canonical_ids(
+            raw_mappings = await self.canonical_reg_id_store.get_canonical_ids(
                 pushkeys
             )
 
-            reg_id_mappings = {
-                reg_id: canonical_reg_id or reg_id
-                for (reg_id, canonical_reg_id) in reg_id_mappings.items()
-            }
-
-            inverse_reg_id_mappings = {v: k for (k, v) in reg_id_mappings.items()}
+            # resolve the canonical IDs (deduplicated, preserving order, so
+            # that pushkeys sharing a canonical ID only produce one FCM
+            # target), build the inverse mapping (one canonical ID to all of
+            # the original pushkeys that resolved to it) and count the
+            # remaps, all in a single pass.
+            mapped_pushkeys = []
+            inverse_reg_id_mappings = {}
+            num_remapped = 0
+            for pk in pushkeys:
+                canonical_pk = raw_mappings.get(pk) or pk
+                originals = inverse_reg_id_mappings.get(canonical_pk)
+                if originals is None:
+                    inverse_reg_id_mappings[canonical_pk] = [pk]
+                    mapped_pushkeys.append(canonical_pk)
+                else:
+                    originals.append(pk)
+                if canonical_pk != pk:
+                    num_remapped += 1
 
             data = GcmPushkin._build_data(n)
-            headers = {
-                b"User-Agent": ["sygnal"],
-                b"Content-Type": ["application/json"],
-                b"Authorization": ["key=%s" % (self.api_key,)],
-            }
 
             # count the number of remapped registration IDs in the request
-            span_parent.set_tag(
-                "gcm_num_remapped_reg_ids_used",
-                [k != v for (k, v) in reg_id_mappings.items()].count(True),
-            )
+            span_parent.set_tag("gcm_num_remapped_reg_ids_used", num_remapped)
 
             # TODO: Implement collapse_key to queue only one message per room.
             failed = []
 
-            body = {"data": data, "priority": "normal" if n.prio == "low" else "high"}
+            priority = "normal" if n.prio == "low" else "high"
+            body = {"data": data, "priority": priority}
 
-            for retry_number in range(0, MAX_TRIES):
-                mapped_pushkeys = [reg_id_mappings[pk] for pk in pushkeys]
+            # the body is encoded once and the bytes reused across retries;
+            # it is only re-encoded when the target set of pushkeys changes.
+            # For a single target (the common case), everything except the
+            # 'to' field is constant, so the target is spliced onto a
+            # pre-encoded prefix instead of re-encoding the whole body.
+            single_target_prefix = None
+            body_bytes = None
 
-                if len(pushkeys) == 1:
-                    body["to"] = mapped_pushkeys[0]
-                else:
-                    body["registration_ids"] = mapped_pushkeys
+            for retry_number in range(0, MAX_TRIES):
+                if body_bytes is None:
+                    if len(mapped_pushkeys) == 1:
+                        if single_target_prefix is None:
+                            single_target_prefix = (
+                                b'{"data":'
+                                + json_dumps(data)
+                                + b',"priority":"'
+                                + priority.encode()
+                                + b'","to":'
+                            )
+                        body_bytes = (
+                            single_target_prefix
+                            + json_dumps(mapped_pushkeys[0])
+                            + b"}"
+                        )
+                    else:
+                        body["registration_ids"] = mapped_pushkeys
+                        body_bytes = json_dumps(body)
 
                 log.info("Sending (attempt %i) => %r", retry_number, mapped_pushkeys)
 
@@ -358,14 +544,14 @@ class GcmPushkin(Pushkin):
                         "gcm_dispatch_try", tags=span_tags, child_of=span_parent
                     ) as span:
                         new_failed, new_pushkeys = await self._request_dispatch(
-                            n, log, body, headers, mapped_pushkeys, span
+                            n, log, body_bytes, mapped_pushkeys, span
                         )
-                    pushkeys = new_pushkeys
-                    failed += [
-                        inverse_reg_id_mappings[canonical_pk]
-                        for canonical_pk in new_failed
-                    ]
-                    if len(pushkeys) == 0:
+                    if new_pushkeys != mapped_pushkeys:
+                        body_bytes = None
+                    mapped_pushkeys = new_pushkeys
+                    for canonical_pk in new_failed:
+                        failed += inverse_reg_id_mappings[canonical_pk]
+                    if len(mapped_pushkeys) == 0:
                         break
                 except TemporaryNotificationDispatchException as exc:
                     retry_delay = RETRY_DELAY_BASE * (2 ** retry_number)
@@ -386,8 +572,8 @@ class GcmPushkin(Pushkin):
                         retry_delay, twisted_reactor=self.sygnal.reactor
                     )
 
-            if len(pushkeys) > 0:
-                log.info("Gave up retrying reg IDs: %r", pushkeys)
+            if len(mapped_pushkeys) > 0:
+                log.info("Gave up retrying reg IDs: %r", mapped_pushkeys)
             # Count the number of failed devices.
             span_parent.set_tag("gcm_num_failed", len(failed))
             return failed
@@ -403,23 +589,19 @@ class GcmPushkin(Pushkin):
             JSON-compatible dict
         """
         data = {}
-        for attr in [
-            "event_id",
-            "type",
-            "sender",
-            "room_name",
-            "room_alias",
-            "membership",
-            "sender_display_name",
-            "content",
-            "room_id",
-        ]:
-            if hasattr(n, attr):
-                data[attr] = getattr(n, attr)
-                # Truncate fields to a sensible maximum length. If the whole
-                # body is too long, GCM will reject it.
-                if data[attr] is not None and len(data[attr]) > MAX_BYTES_PER_FIELD:
-                    data[attr] = data[attr][0:MAX_BYTES_PER_FIELD]
+        for attr in DATA_ATTRIBUTES:
+            value = getattr(n, attr, None)
+            # Truncate fields to a sensible maximum length. If the whole
+            # body is too long, GCM will reject it. The limit applies to the
+            # UTF-8 encoded length (which is what ends up on the wire), not
+            # the number of code points; a field of up to
+            # MAX_BYTES_PER_FIELD // 4 code points cannot exceed it, so the
+            # common short case skips the encode entirely.
+            if isinstance(value, str) and len(value) * 4 > MAX_BYTES_PER_FIELD:
+                encoded = value.encode("utf-8")
+                if len(encoded) > MAX_BYTES_PER_FIELD:
+                    value = encoded[:MAX_BYTES_PER_FIELD].decode("utf-8", "ignore")
+            data[attr] = value
 
         data["prio"] = "high"
         if n.prio == "low":
@@ -440,8 +622,21 @@ class CanonicalRegIdStore(object):
         );
         """
 
+    # Maximum number of registration IDs to look up in a single query;
+    # SQLite only allows 999 bound parameters by default
+    # (SQLITE_MAX_VARIABLE_NUMBER).
+    MAX_QUERY_PARAMETERS = 900
+
+    # Maximum number of mappings to keep in the in-process cache.
+    MAX_CACHE_SIZE = 100000
+
     def __init__(self):
         self.db = None
+        # In-process LRU cache of reg_id → canonical_reg_id (or None if the
+        # database has no mapping for it). The mapping only ever changes via
+        # `set_canonical_id`, which keeps the cache up to date, so cached
+        # entries never go stale.
+        self._cache = OrderedDict()
 
     async def setup(self, db, engine):
         """
@@ -461,6 +656,11 @@ class CanonicalRegIdStore(object):
 
         await self.db.runOperation(self.TABLE_CREATE_QUERY)
 
+        if engine == "sqlite":
+            # write-ahead logging makes the burst of canonical-ID updates
+            # after an FCM response considerably cheaper.
+            await self.db.runOperation("PRAGMA journal_mode = WAL;")
+
     async def set_canonical_id(self, reg_id, canonical_reg_id):
         """
         Associates a GCM registration ID with a canonical registration ID.
@@ -483,6 +683,46 @@ class CanonicalRegIdStore(object):
                 (reg_id, canonical_reg_id),
             )
 
+        self._cache_set(reg_id, canonical_reg_id)
+
+    async def set_canonical_ids(self, canonical_ids):
+        """
+        Associates many GCM registration IDs with canonical registration IDs,
+        in one database round-trip.
+        Args:
+            canonical_ids (list): `(reg_id, canonical_reg_id)` pairs to store.
+        """
+        if self.engine == "sqlite":
+            query = "INSERT OR REPLACE INTO gcm_canonical_reg_id VALUES (?, ?);"
+        else:
+            query = """
+                INSERT INTO gcm_canonical_reg_id VALUES (%s, %s)
+                ON CONFLICT (reg_id) DO UPDATE
+                    SET canonical_reg_id = EXCLUDED.canonical_reg_id;
+                """
+
+        def set_canonical_ids_txn(txn):
+            txn.executemany(query, canonical_ids)
+
+        await self.db.runInteraction(set_canonical_ids_txn)
+
+        for (reg_id, canonical_reg_id) in canonical_ids:
+            self._cache_set(reg_id, canonical_reg_id)
+
+    def _cache_set(self, reg_id, canonical_reg_id):
+        """
+        Adds or updates a mapping in the in-process cache, evicting the
+        least-recently-used entry if the cache is full.
+        Args:
+            reg_id (str): a registration ID
+            canonical_reg_id (str|None): the canonical registration ID for
+                `reg_id`, or `None` if there is none.
+        """
+        self._cache[reg_id] = canonical_reg_id
+        self._cache.move_to_end(reg_id)
+        if len(self._cache) > self.MAX_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
     async def get_canonical_ids(self, reg_ids):
         """
         Retrieves the canonical registration ID for multiple registration IDs.
@@ -495,16 +735,52 @@ class CanonicalRegIdStore(object):
             mapping of registration ID to either its canonical registration ID,
             or `None` if there is no entry.
         """
+        reg_ids = list(reg_ids)
+
+        result = {}
+        uncached = []
+        for reg_id in reg_ids:
+            if reg_id in self._cache:
+                self._cache.move_to_end(reg_id)
+                result[reg_id] = self._cache[reg_id]
+            else:
+                uncached.append(reg_id)
+
+        if uncached:
+            found = await self._query_canonical_ids(uncached)
+            for reg_id in uncached:
+                canonical_reg_id = found.get(reg_id)
+                self._cache_set(reg_id, canonical_reg_id)
+                result[reg_id] = canonical_reg_id
+
+        return result
+
+    async def _query_canonical_ids(self, reg_ids):
+        """
+        Looks up canonical registration IDs in the database, bypassing the
+        in-process cache.
+
+        Args:
+            reg_ids (list): registration IDs to retrieve canonical registration
+                IDs for.
+
+        Returns (dict):
+            mapping of registration ID to its canonical registration ID;
+            registration IDs with no entry are absent.
+        """
         parameter_key = "?" if self.engine == "sqlite" else "%s"
-        rows = dict(
-            await self.db.runQuery(
-                """
-                SELECT reg_id, canonical_reg_id
-                FROM gcm_canonical_reg_id
-                WHERE reg_id IN (%s)
-                """
-                % (",".join(parameter_key for _ in reg_ids)),
-                reg_ids,
+        found = {}
+        for chunk_start in range(0, len(reg_ids), self.MAX_QUERY_PARAMETERS):
+            chunk = reg_ids[chunk_start : chunk_start + self.MAX_QUERY_PARAMETERS]
+            found.update(
+                await self.db.runQuery(
+                    """
+                    SELECT reg_id, canonical_reg_id
+                    FROM gcm_canonical_reg_id
+                    WHERE reg_id IN (%s)
+                    """
+                    % (",".join(parameter_key for _ in chunk)),
+                    chunk,
+                )
             )
-        )
-        return {reg_id: dict(rows).get(reg_id) for reg_id in reg_ids}
+        return found
@@ -14,14 +14,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import json
 import logging
 import sys
 import time
 import traceback
 import re
-from uuid import uuid4
+from collections.abc import Mapping
+from io import BytesIO
 
+import opentracing
 from opentracing import Format, logs, tags
 from prometheus_client import Counter, Gauge, Histogram
 from twisted.internet.defer import ensureDeferred
@@ -35,13 +36,41 @@ from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
 from sygnal.notifications import NotificationContext
-from sygnal.utils import NotificationLoggerAdapter
+from sygnal.utils import (
+    ContextRequestIdLoggerAdapter,
+    fast_request_id,
+    json_dumps,
+    json_loads,
+    set_log_request_id,
+)
 
 from .exceptions import InvalidNotificationException, NotificationDispatchException
 from .notifications import Notification
 
 logger = logging.getLogger(__name__)
 
+# The no-op tracer that opentracing installs by default, captured at import
+# time. `opentracing.tracer` itself cannot be compared against later because
+# jaeger_client's initialize_tracer() rebinds it (via set_global_tracer) to
+# the real tracer, which would make the comparison a self-comparison.
+_NOOP_TRACER = opentracing.tracer
+
+# one adapter shared by all requests; the request ID comes from the
+# current context (see set_log_request_id) rather than per-adapter state.
+_request_logger = ContextRequestIdLoggerAdapter(logger, {})
+
+# most requests reject nothing, so the response body is a constant.
+_EMPTY_REJECTED_RESPONSE = b'{"rejected":[]}'
+
+# constant error messages, pre-encoded so the 400 paths need not call
+# str.encode per request. The str forms are kept for logging.
+_MSG_EXPECTED_JSON = "Expected JSON request body"
+_MSG_EXPECTED_JSON_BYTES = _MSG_EXPECTED_JSON.encode()
+_MSG_INVALID_NOTIF = "Invalid notification: expecting object in 'notification' key"
+_MSG_INVALID_NOTIF_BYTES = _MSG_INVALID_NOTIF.encode()
+_MSG_NO_DEVICES = "No devices in notification"
+_MSG_NO_DEVICES_BYTES = _MSG_NO_DEVICES.encode()
+
 NOTIFS_RECEIVED_COUNTER = Counter(
     "sygnal_notifications_received", "Number of notification pokes received"
 )
@@ -75,10 +104,53 @@ REQUESTS_IN_FLIGHT_GUAGE = Gauge(
 )
 
 
+class _LazyHeaderCarrier(Mapping):
+    """
+    Presents a request's headers as the str→str mapping that the
+    OpenTracing HTTP_HEADERS codec expects, decoding them only when they
+    are actually read. A tracer only looks up a handful of specific keys —
+    and the default no-op tracer reads none at all — so eagerly decoding
+    every header per request is wasted work.
+    """
+
+    def __init__(self, request_headers):
+        self._headers = request_headers
+
+    def __getitem__(self, key):
+        values = self._headers.getRawHeaders(key)
+        if not values:
+            raise KeyError(key)
+        return values[0]
+
+    def __iter__(self):
+        for name, _values in self._headers.getAllRawHeaders():
+            yield name.decode()
+
+    def __len__(self):
+        return sum(1 for _ in self._headers.getAllRawHeaders())
+
+
+# pre-bound .inc methods: counting happens per request or per device, and
+# the attribute lookups are avoidable there.
+_NOTIFS_RECEIVED_INC = NOTIFS_RECEIVED_COUNTER.inc
+_NOTIFS_RECEIVED_DEVICE_PUSH_INC = NOTIFS_RECEIVED_DEVICE_PUSH_COUNTER.inc
+
+
 class V1NotifyHandler(Resource):
     def __init__(self, sygnal):
         super().__init__()
         self.sygnal = sygnal
+        # pre-resolved metric handles: .labels() takes a lock and hashes
+        # its arguments on every call, so resolve the in-flight gauge once
+        # and cache each pushkin's counter the first time it is used.
+        self._in_flight_gauge = REQUESTS_IN_FLIGHT_GUAGE.labels(
+            self.__class__.__name__
+        )
+        self._notifs_by_pushkin_incs = {}
+        # when the configured tracer is the default no-op tracer, span tags
+        # and logs go nowhere, so skip building the dicts and strings they
+        # would be fed.
+        self._tracing_enabled = sygnal.tracer is not _NOOP_TRACER
 
     isLeaf = True
 
@@ -88,7 +160,7 @@ class V1NotifyHandler(Resource):
         be followed through logging.
         Returns: a request ID for the request.
         """
-        return str(uuid4())
+        return fast_request_id()
 
     def render_POST(self, request):
         response = self._handle_request(request)
@@ -107,21 +179,24 @@ class V1NotifyHandler(Resource):
 
         """
         request_id = self._make_request_id()
-        header_dict = {
-            k.decode(): v[0].decode()
-            for k, v in request.requestHeaders.getAllRawHeaders()
-        }
-
-        # extract OpenTracing scope from the HTTP headers
-        span_ctx = self.sygnal.tracer.extract(Format.HTTP_HEADERS, header_dict)
-        span_tags = {
-            tags.SPAN_KIND: tags.SPAN_KIND_RPC_SERVER,
-            "request_id": request_id,
-        }
-
-        root_span = self.sygnal.tracer.start_span(
-            "pushgateway_v1_notify", child_of=span_ctx, tags=span_tags
-        )
+
+        if self._tracing_enabled:
+            # extract OpenTracing scope from the HTTP headers
+            span_ctx = self.sygnal.tracer.extract(
+                Format.HTTP_HEADERS, _LazyHeaderCarrier(request.requestHeaders)
+            )
+            span_tags = {
+                tags.SPAN_KIND: tags.SPAN_KIND_RPC_SERVER,
+                "request_id": request_id,
+            }
+
+            root_span = self.sygnal.tracer.start_span(
+                "pushgateway_v1_notify", child_of=span_ctx, tags=span_tags
+            )
+        else:
+            # the no-op tracer never reads the carrier or the tags, so
+            # don't build them; its spans are free-standing no-ops.
+            root_span = self.sygnal.tracer.start_span("pushgateway_v1_notify")
 
         # if this is True, we will not close the root_span at the end of this
         # function.
@@ -130,73 +205,89 @@ class V1NotifyHandler(Resource):
         try:
             context = NotificationContext(request_id, root_span, time.perf_counter())
 
-            log = NotificationLoggerAdapter(logger, {"request_id": request_id})
+            set_log_request_id(request_id)
+            log = _request_logger
 
             try:
-                body = json.loads(request.content.read())
+                content = request.content
+                if isinstance(content, BytesIO):
+                    # Twisted buffers small request bodies in a BytesIO;
+                    # parse straight out of its buffer instead of copying
+                    # the whole body out with read() first.
+                    with content.getbuffer() as raw_body:
+                        body = json_loads(raw_body)
+                else:
+                    body = json_loads(content.read())
             except Exception as exc:
-                msg = "Expected JSON request body"
-                log.warning(msg, exc_info=exc)
-                root_span.log_kv({logs.EVENT: "error", "error.object": exc})
+                log.warning(_MSG_EXPECTED_JSON, exc_info=exc)
+                if self._tracing_enabled:
+                    root_span.log_kv({logs.EVENT: "error", "error.object": exc})
                 request.setResponseCode(400)
-                return msg.encode()
-
-            if "notification" not in body or not isinstance(body["notification"], dict):
-                msg = "Invalid notification: expecting object in 'notification' key"
-                log.warning(msg)
-                root_span.log_kv({logs.EVENT: "error", "message": msg})
+                return _MSG_EXPECTED_JSON_BYTES
+
+            # the body may be valid JSON without being an object; the single
+            # .get() lookup covers both the missing-key and wrong-type cases
+            notification = body.get("notification") if isinstance(body, dict) else None
+            if not isinstance(notification, dict):
+                log.warning(_MSG_INVALID_NOTIF)
+                if self._tracing_enabled:
+                    root_span.log_kv(
+                        {logs.EVENT: "error", "message": _MSG_INVALID_NOTIF}
+                    )
                 request.setResponseCode(400)
-                return msg.encode()
+                return _MSG_INVALID_NOTIF_BYTES
 
             try:
-                notif = Notification(body["notification"])
+                notif = Notification(notification)
             except InvalidNotificationException as e:
                 log.exception("Invalid notification")
                 request.setResponseCode(400)
-                root_span.log_kv({logs.EVENT: "error", "error.object": e})
+                if self._tracing_enabled:
+                    root_span.log_kv({logs.EVENT: "error", "error.object": e})
                 return str(e).encode()
 
-            if notif.event_id is not None:
-                root_span.set_tag("event_id", notif.event_id)
+            if self._tracing_enabled:
+                if notif.event_id is not None:
+                    root_span.set_tag("event_id", notif.event_id)
 
-            # track whether the notification was passed with content
-            root_span.set_tag("has_content", notif.content is not None)
+                # track whether the notification was passed with content
+                root_span.set_tag("has_content", notif.content is not None)
 
-            NOTIFS_RECEIVED_COUNTER.inc()
+            _NOTIFS_RECEIVED_INC()
 
-            if len(notif.devices) == 0:
-                msg = "No devices in notification"
-                log.warning(msg)
+            if not notif.devices:
+                log.warning(_MSG_NO_DEVICES)
                 request.setResponseCode(400)
-                return msg.encode()
+                return _MSG_NO_DEVICES_BYTES
 
             root_span_accounted_for = True
 
-            async def cb():
-                with REQUESTS_IN_FLIGHT_GUAGE.labels(
-                    self.__class__.__name__
-                ).track_inprogress():
-                    await self._handle_dispatch(root_span, request, log, notif, context)
-
-            ensureDeferred(cb())
+            # no wrapper closure here: _handle_dispatch tracks the
+            # in-flight gauge itself, so one coroutine per request suffices.
+            ensureDeferred(
+                self._handle_dispatch(root_span, request, log, notif, context)
+            )
 
             # we have to try and send the notifications first,
             # so we can find out which ones to reject
             return NOT_DONE_YET
         except Exception as exc_val:
-            root_span.set_tag(tags.ERROR, True)
-
-            # [2] corresponds to the traceback
-            trace = traceback.format_tb(sys.exc_info()[2])
-            root_span.log_kv(
-                {
-                    logs.EVENT: tags.ERROR,
-                    logs.MESSAGE: str(exc_val),
-                    logs.ERROR_OBJECT: exc_val,
-                    logs.ERROR_KIND: type(exc_val),
-                    logs.STACK: trace,
-                }
-            )
+            # formatting the traceback is not cheap, so only do it when a
+            # real tracer is attached to record it.
+            if self._tracing_enabled:
+                root_span.set_tag(tags.ERROR, True)
+
+                # [2] corresponds to the traceback
+                trace = traceback.format_tb(sys.exc_info()[2])
+                root_span.log_kv(
+                    {
+                        logs.EVENT: tags.ERROR,
+                        logs.MESSAGE: str(exc_val),
+                        logs.ERROR_OBJECT: exc_val,
+                        logs.ERROR_KIND: type(exc_val),
+                        logs.STACK: trace,
+                    }
+                )
             raise
         finally:
             if not root_span_accounted_for:
@@ -214,9 +305,11 @@ class V1NotifyHandler(Resource):
                 the exact app id, immediately returns it.
                 Otherwise returns possible pushkins.
         """
-        # if found a specific appid, just return it as a list
-        if appid in self.sygnal.pushkins:
-            return [self.sygnal.pushkins[appid]]
+        # if found a specific appid, just return it as a list; .get() does
+        # the membership test and the retrieval in a single lookup
+        pushkin = self.sygnal.pushkins.get(appid)
+        if pushkin is not None:
+            return [pushkin]
 
         result = []
         for key, value in self.sygnal.pushkins.items():
@@ -237,11 +330,18 @@ class V1NotifyHandler(Resource):
         notif (Notification): the notification to dispatch
         context (NotificationContext): the context of the notification
         """
+        in_flight_gauge = self._in_flight_gauge
+        in_flight_gauge.inc()
         try:
             rejected = []
 
+            # resolve every device to its pushkin first, so each pushkin
+            # gets all of its devices in a single batch dispatch rather
+            # than one call per device.
+            batches = {}
+
             for d in notif.devices:
-                NOTIFS_RECEIVED_DEVICE_PUSH_COUNTER.inc()
+                _NOTIFS_RECEIVED_DEVICE_PUSH_INC()
 
                 appid = d.app_id
                 found_pushkins = self.find_pushkins(appid)
@@ -260,21 +360,39 @@ class V1NotifyHandler(Resource):
                     "Sending push to pushkin %s for app ID %s", pushkin.name, appid
                 )
 
-                NOTIFS_BY_PUSHKIN.labels(pushkin.name).inc()
-
-                result = await pushkin.dispatch_notification(notif, d, context)
+                notifs_inc = self._notifs_by_pushkin_incs.get(pushkin.name)
+                if notifs_inc is None:
+                    notifs_inc = NOTIFS_BY_PUSHKIN.labels(pushkin.name).inc
+                    self._notifs_by_pushkin_incs[pushkin.name] = notifs_inc
+                notifs_inc()
+
+                batch = batches.get(pushkin.name)
+                if batch is None:
+                    batches[pushkin.name] = (pushkin, [d])
+                else:
+                    batch[1].append(d)
+
+            for pushkin, devices in batches.values():
+                result = await pushkin.dispatch_notification_batch(
+                    notif, devices, context
+                )
                 if not isinstance(result, list):
                     raise TypeError("Pushkin should return list.")
 
                 rejected += result
 
-            request.write(json.dumps({"rejected": rejected}).encode())
+            request.responseHeaders.setRawHeaders(
+                b"content-type", [b"application/json"]
+            )
 
             if rejected:
+                request.write(json_dumps({"rejected": rejected}))
                 log.info(
                     "Successfully delivered notifications with %d rejected pushkeys",
                     len(rejected),
                 )
+            else:
+                request.write(_EMPTY_REJECTED_RESPONSE)
         except NotificationDispatchException:
             request.setResponseCode(502)
             log.warning("Failed to dispatch notification.", exc_info=True)
@@ -286,15 +404,17 @@ class V1NotifyHandler(Resource):
                 request.finish()
 
             PUSHGATEWAY_HTTP_RESPONSES_COUNTER.labels(code=request.code).inc()
-            root_span.set_tag(tags.HTTP_STATUS_CODE, request.code)
+            if self._tracing_enabled:
+                root_span.set_tag(tags.HTTP_STATUS_CODE, request.code)
 
             req_time = time.perf_counter() - context.start_time
             if req_time > 0:
                 # can be negative as perf_counter() may not be monotonic
                 NOTIFY_HANDLE_HISTOGRAM.labels(code=request.code).observe(req_time)
-            if not 200 <= request.code < 300:
+            if self._tracing_enabled and not 200 <= request.code < 300:
                 root_span.set_tag(tags.ERROR, True)
             root_span.finish()
+            in_flight_gauge.dec()
 
 
 class HealthHandler(Resource):
@@ -326,6 +446,32 @@ class SygnalLoggedSite(server.Site):
         self.logger.info("Handled request: %s", line)
 
 
+class _RootResource(Resource):
+    """
+    The root of the resource tree, with a short-circuit for the notify
+    endpoint: nearly every request is for /_matrix/push/v1/notify, and
+    walking the four-level tree costs a dict lookup and a prepath update
+    per segment. When the remaining path matches exactly, hand back the
+    notify handler directly; anything else falls through to the normal
+    traversal.
+    """
+
+    _NOTIFY_POSTPATH = [b"push", b"v1", b"notify"]
+
+    def __init__(self, notify_handler):
+        super().__init__()
+        self._notify_handler = notify_handler
+
+    def getChildWithDefault(self, path, request):
+        if path == b"_matrix" and request.postpath == self._NOTIFY_POSTPATH:
+            # b"_matrix" is already on the prepath; consume the rest so the
+            # request looks exactly as it would after a full traversal.
+            del request.postpath[:]
+            request.prepath += self._NOTIFY_POSTPATH
+            return self._notify_handler
+        return super().getChildWithDefault(path, request)
+
+
 class PushGatewayApiServer(object):
     def __init__(self, sygnal):
         """
@@ -333,7 +479,9 @@ class PushGatewayApiServer(object):
         Args:
             sygnal (Sygnal): the Sygnal object
         """
-        root = Resource()
+        notify = V1NotifyHandler(sygnal)
+
+        root = _RootResource(notify)
         matrix = Resource()
         push = Resource()
         v1 = Resource()
@@ -342,7 +490,7 @@ class PushGatewayApiServer(object):
         root.putChild(b"_matrix", matrix)
         matrix.putChild(b"push", push)
         push.putChild(b"v1", v1)
-        v1.putChild(b"notify", V1NotifyHandler(sygnal))
+        v1.putChild(b"notify", notify)
 
         # add health
         root.putChild(b"health", HealthHandler())
@@ -61,36 +61,40 @@ class Counts:
             self.missed_calls = raw["missed_calls"]
 
 
+# The attributes a notification may carry besides 'devices' and 'counts';
+# missing ones are set to None.
+OPTIONAL_NOTIFICATION_ATTRS = (
+    "room_name",
+    "room_alias",
+    "prio",
+    "membership",
+    "sender_display_name",
+    "content",
+    "event_id",
+    "room_id",
+    "user_is_target",
+    "type",
+    "sender",
+)
+
+
 class Notification:
     def __init__(self, notif):
-        optional_attrs = [
-            "room_name",
-            "room_alias",
-            "prio",
-            "membership",
-            "sender_display_name",
-            "content",
-            "event_id",
-            "room_id",
-            "user_is_target",
-            "type",
-            "sender",
-        ]
-        for a in optional_attrs:
-            if a in notif:
-                self.__dict__[a] = notif[a]
-            else:
-                self.__dict__[a] = None
-
-        if "devices" not in notif or not isinstance(notif["devices"], list):
+        # .get() does the membership test and the retrieval in a single
+        # lookup, and missing keys come out as None directly.
+        notif_get = notif.get
+        self_dict = self.__dict__
+        for a in OPTIONAL_NOTIFICATION_ATTRS:
+            self_dict[a] = notif_get(a)
+
+        devices = notif_get("devices")
+        if not isinstance(devices, list):
             raise InvalidNotificationException("Expected list in 'devices' key")
 
-        if "counts" in notif:
-            self.counts = Counts(notif["counts"])
-        else:
-            self.counts = Counts({})
+        counts = notif_get("counts")
+        self.counts = Counts(counts if counts is not None else {})
 
-        self.devices = [Device(d) for d in notif["devices"]]
+        self.devices = [Device(d) for d in devices]
 
 
 class Pushkin(object):
@@ -116,6 +120,30 @@ class Pushkin(object):
         """
         pass
 
+    async def dispatch_notification_batch(self, n, devices, context):
+        """
+        Dispatches a notification to multiple devices handled by this pushkin.
+
+        Pushkins whose downstream service can address several devices in one
+        request should override this. The default implementation just sends
+        to each device individually via `dispatch_notification`.
+
+        Args:
+            n: The notification to dispatch via this pushkin
+            devices (list): The devices to dispatch the notification for.
+            context (NotificationContext): the request context
+
+        Returns:
+            A list of rejected pushkeys, to be reported back to the homeserver
+        """
+        rejected = []
+        for device in devices:
+            result = await self.dispatch_notification(n, device, context)
+            if not isinstance(result, list):
+                raise TypeError("Pushkin should return list.")
+            rejected += result
+        return rejected
+
     @classmethod
     async def create(cls, name, sygnal, config):
         """
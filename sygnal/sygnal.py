@@ -14,7 +14,6 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import copy
 import importlib
 import logging
 import logging.config
@@ -22,16 +21,26 @@ import os
 import sys
 
 import opentracing
-import prometheus_client
 
 # import twisted.internet.reactor
 import yaml
+
+# use libYAML's C parser to load the configuration when PyYAML was built
+# with it; the pure-Python parser is several times slower and runs on the
+# startup path.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 from opentracing.scope_managers.asyncio import AsyncioScopeManager
 from twisted.enterprise.adbapi import ConnectionPool
 from twisted.internet import asyncioreactor, defer
 from twisted.internet.defer import ensureDeferred
 from twisted.python import log as twisted_log
 from twisted.python.failure import Failure
+from twisted.web.resource import Resource
+from twisted.web.server import Site
 
 from sygnal.http import PushGatewayApiServer
 
@@ -56,6 +65,18 @@ CONFIG_DEFAULTS = {
     "database": None,
 }
 
+# the keys understood in each configuration section, for check_config.
+KNOWN_HTTP_KEYS = frozenset({"port", "bind_addresses"})
+KNOWN_LOG_KEYS = frozenset({"setup", "access"})
+KNOWN_LOG_ACCESS_KEYS = frozenset({"file", "enabled", "x_forwarded_for"})
+KNOWN_METRICS_KEYS = frozenset({"opentracing", "sentry", "prometheus"})
+KNOWN_OPENTRACING_KEYS = frozenset(
+    {"enabled", "implementation", "jaeger", "service_name"}
+)
+KNOWN_PROMETHEUS_KEYS = frozenset({"enabled", "address", "port"})
+KNOWN_SENTRY_KEYS = frozenset({"enabled", "dsn"})
+KNOWN_DATABASE_KEYS = frozenset({"name", "args"})
+
 
 class Sygnal(object):
     def __init__(self, config, custom_reactor, tracer=opentracing.tracer):
@@ -110,7 +131,16 @@ class Sygnal(object):
                 "Starting Prometheus Server on %s port %d", prom_addr, prom_port
             )
 
-            prometheus_client.start_http_server(port=prom_port, addr=prom_addr or "")
+            # serve the metrics from the reactor rather than via
+            # prometheus_client.start_http_server, which spins up a
+            # threaded WSGI server of its own just for scrapes.
+            from prometheus_client.twisted import MetricsResource
+
+            metrics_root = Resource()
+            metrics_root.putChild(b"metrics", MetricsResource())
+            self.reactor.listenTCP(
+                prom_port, Site(metrics_root), interface=prom_addr or ""
+            )
 
         tracecfg = config["metrics"]["opentracing"]
         if tracecfg["enabled"] is True:
@@ -245,7 +275,7 @@ def parse_config():
     config_path = os.getenv("SYGNAL_CONF", "sygnal.yaml")
     try:
         with open(config_path) as file_handle:
-            return yaml.safe_load(file_handle)
+            return yaml.load(file_handle, Loader=SafeLoader)
     except FileNotFoundError:
         logger.critical(
             "Could not find configuration file!\n" "Path: %s\n" "Absolute Path: %s",
@@ -278,21 +308,13 @@ def check_config(config):
             "The following configuration fields are not understood: %s", nonunderstood
         )
 
-    check_section("http", {"port", "bind_addresses"})
-    check_section("log", {"setup", "access"})
-    check_section(
-        "access", {"file", "enabled", "x_forwarded_for"}, cfgpart=config["log"]
-    )
-    check_section("metrics", {"opentracing", "sentry", "prometheus"})
-    check_section(
-        "opentracing",
-        {"enabled", "implementation", "jaeger", "service_name"},
-        cfgpart=config["metrics"],
-    )
-    check_section(
-        "prometheus", {"enabled", "address", "port"}, cfgpart=config["metrics"]
-    )
-    check_section("sentry", {"enabled", "dsn"}, cfgpart=config["metrics"])
+    check_section("http", KNOWN_HTTP_KEYS)
+    check_section("log", KNOWN_LOG_KEYS)
+    check_section("access", KNOWN_LOG_ACCESS_KEYS, cfgpart=config["log"])
+    check_section("metrics", KNOWN_METRICS_KEYS)
+    check_section("opentracing", KNOWN_OPENTRACING_KEYS, cfgpart=config["metrics"])
+    check_section("prometheus", KNOWN_PROMETHEUS_KEYS, cfgpart=config["metrics"])
+    check_section("sentry", KNOWN_SENTRY_KEYS, cfgpart=config["metrics"])
 
     # If 'db' is defined, it will override the 'database' config.
     if "db" in config:
@@ -301,7 +323,28 @@ def check_config(config):
 See the sample config for help."""
         )
     else:
-        check_section("database", {"name", "args"})
+        check_section("database", KNOWN_DATABASE_KEYS)
+
+
+def _copy_config_value(value):
+    """
+    Copies a configuration value, recursing into dicts and lists.
+
+    Configuration values are plain YAML-style data, so this covers
+    everything `copy.deepcopy` would while skipping its generic machinery
+    (memo bookkeeping, reduce-protocol dispatch).
+
+    Args:
+        value: the configuration value to copy.
+
+    Returns:
+        A copy of `value`, sharing no mutable state with it.
+    """
+    if isinstance(value, dict):
+        return {k: _copy_config_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_config_value(v) for v in value]
+    return value
 
 
 def merge_left_with_defaults(defaults, loaded_config):
@@ -325,7 +368,7 @@ def merge_left_with_defaults(defaults, loaded_config):
             if k in loaded_config:
                 result[k] = merge_left_with_defaults(v, loaded_config[k])
             else:
-                result[k] = copy.deepcopy(v)
+                result[k] = _copy_config_value(v)
         elif k in loaded_config:
             result[k] = loaded_config[k]
 
@@ -338,6 +381,16 @@ def merge_left_with_defaults(defaults, loaded_config):
 
 
 if __name__ == "__main__":
+    # run the asyncio event loop on uvloop (libuv) when it is installed;
+    # the stdlib selector loop dispatches events in pure Python, which is
+    # measurable for a reactor juggling many concurrent push connections.
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        uvloop.install()
+
     # TODO we don't want to have to install the reactor, when we can get away with
     #   it
     asyncioreactor.install()
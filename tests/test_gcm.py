@@ -14,7 +14,12 @@
 # limitations under the License.
 import json
 
-from sygnal.gcmpushkin import GcmPushkin
+from twisted.internet.defer import Deferred, ensureDeferred
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone
+
+from sygnal.gcmpushkin import GcmPushkin, _BodyReader, _BytesBodyProducer
 from tests import testutils
 from tests.testutils import DummyResponse
 
@@ -43,11 +48,14 @@ class TestGcmPushkin(GcmPushkin):
         self.preloaded_response = DummyResponse(code)
         self.preloaded_response_payload = response_payload
 
-    async def _perform_http_request(self, body, headers):
-        self.last_request_body = body
-        self.last_request_headers = headers
+    async def _perform_http_request(self, body):
+        self.last_request_body = json.loads(body)
+        self.last_request_headers = self._request_headers
         self.num_requests += 1
-        return self.preloaded_response, json.dumps(self.preloaded_response_payload)
+        return (
+            self.preloaded_response,
+            json.dumps(self.preloaded_response_payload).encode(),
+        )
 
 
 class GcmTestCase(testutils.TestCase):
@@ -196,3 +204,135 @@ class GcmTestCase(testutils.TestCase):
         # make sense of it otherwise.
         self.assertEqual(resp, {"rejected": ["spqr"]})
         self.assertEqual(gcm.num_requests, 2)
+
+
+class BodyReaderTestCase(unittest.TestCase):
+    def _deliver(self, chunks, reason, max_length=None):
+        """
+        Feeds the given body chunks to a _BodyReader, then closes the
+        connection with the given reason.
+        Returns:
+            the Deferred the reader reports its result on.
+        """
+        deferred = Deferred()
+        reader = _BodyReader(deferred, max_length=max_length)
+        for chunk in chunks:
+            reader.dataReceived(chunk)
+        reader.connectionLost(Failure(reason))
+        return deferred
+
+    def test_collects_body_chunks(self):
+        """
+        Tests that a body delivered in several chunks is handed back whole
+        once the response completes.
+        """
+        deferred = self._deliver([b"res", b"pon", b"se"], ResponseDone())
+        self.assertEqual(self.successResultOf(deferred), b"response")
+
+    def test_connection_failure_is_propagated(self):
+        """
+        Tests that losing the connection for a reason other than a complete
+        response fails the Deferred rather than handing back a partial body.
+        """
+        deferred = self._deliver([b"par"], RuntimeError("synthetic failure"))
+        self.failureResultOf(deferred, RuntimeError)
+
+    def test_max_length_truncates_body(self):
+        """
+        Tests that no more than max_length bytes are kept, while the excess
+        is still drained without error.
+        """
+        deferred = self._deliver([b"abcd", b"efgh"], ResponseDone(), max_length=6)
+        self.assertEqual(self.successResultOf(deferred), b"abcdef")
+
+    def test_max_length_zero_discards_body(self):
+        """
+        Tests that max_length=0 (used for responses whose body we do not
+        care about) drains the body entirely.
+        """
+        deferred = self._deliver([b"abcd", b"efgh"], ResponseDone(), max_length=0)
+        self.assertEqual(self.successResultOf(deferred), b"")
+
+
+class BytesBodyProducerTestCase(unittest.TestCase):
+    def test_writes_whole_body(self):
+        """
+        Tests that the producer advertises the body's length and writes it
+        to the consumer in one go.
+        """
+        written = []
+
+        class Consumer(object):
+            def write(self, data):
+                written.append(data)
+
+        producer = _BytesBodyProducer(b"request body")
+        self.assertEqual(producer.length, 12)
+        deferred = producer.startProducing(Consumer())
+        self.successResultOf(deferred)
+        self.assertEqual(written, [b"request body"])
+
+
+class GcmWorkerPoolTestCase(testutils.TestCase):
+    def config_setup(self, config):
+        super(GcmWorkerPoolTestCase, self).config_setup(config)
+        # a single worker, so both requests in the failure test below are
+        # served by the same one
+        config["apps"]["com.example.gcm"] = {
+            "type": "tests.test_gcm.TestGcmPushkin",
+            "api_key": "kii",
+            "max_connections": 1,
+        }
+
+    def _perform_request(self, gcm, body):
+        """
+        Queues a request via the real (queue-backed) _perform_http_request;
+        TestGcmPushkin overrides it to bypass the queue, so the base class
+        implementation is invoked explicitly.
+        """
+        return ensureDeferred(GcmPushkin._perform_http_request(gcm, body))
+
+    def test_worker_round_trip(self):
+        """
+        Tests that a queued request is picked up by a request worker and
+        its result handed back to the caller.
+        """
+        gcm = self.sygnal.pushkins["com.example.gcm"]
+        sent_bodies = []
+
+        async def fake_send(body):
+            sent_bodies.append(body)
+            return (DummyResponse(200), b"{}")
+
+        gcm._send_http_request = fake_send
+
+        response, response_body = self.successResultOf(
+            self._perform_request(gcm, b"hello")
+        )
+
+        self.assertEqual(sent_bodies, [b"hello"])
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response_body, b"{}")
+
+    def test_worker_survives_request_failure(self):
+        """
+        Tests that an exception whilst performing a request is propagated
+        to the caller, and that the worker goes on to serve the next
+        request.
+        """
+        gcm = self.sygnal.pushkins["com.example.gcm"]
+
+        async def failing_send(body):
+            raise RuntimeError("synthetic failure")
+
+        gcm._send_http_request = failing_send
+        self.failureResultOf(self._perform_request(gcm, b"boom"), RuntimeError)
+
+        async def fake_send(body):
+            return (DummyResponse(200), b"{}")
+
+        gcm._send_http_request = fake_send
+        response, _response_body = self.successResultOf(
+            self._perform_request(gcm, b"hello")
+        )
+        self.assertEqual(response.code, 200)
@@ -13,10 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import opentracing
+
 from sygnal.exceptions import (
     NotificationDispatchException,
     TemporaryNotificationDispatchException,
 )
+from sygnal.http import V1NotifyHandler
 from sygnal.notifications import Pushkin
 
 from tests import testutils
@@ -134,6 +137,35 @@ class PushGatewayApiV1TestCase(testutils.TestCase):
         """
         self.assertEqual(self._request({}), 400)
 
+    def test_bad_requests_with_non_object_body_give_400(self):
+        """
+        Test that requests whose body is valid JSON, but not a JSON object,
+        lead to a 400 Bad Request response rather than an internal error.
+        """
+        self.assertEqual(self._request("[]"), 400)
+        self.assertEqual(self._request('"foo"'), 400)
+
+    def test_tracing_gated_on_configured_tracer(self):
+        """
+        Test that the handler skips span tagging and trace context extraction
+        only when the configured tracer is the default no-op one. A real
+        tracer must not be mistaken for it, even though it also installs
+        itself as the opentracing global tracer (as jaeger_client's
+        initialize_tracer does).
+        """
+        self.assertFalse(V1NotifyHandler(self.sygnal)._tracing_enabled)
+
+        real_tracer = opentracing.Tracer()
+        old_global_tracer = opentracing.tracer
+        # what opentracing.set_global_tracer does, without the module-level
+        # registration flag that cannot be unset afterwards
+        opentracing.tracer = real_tracer
+        try:
+            self.sygnal.tracer = real_tracer
+            self.assertTrue(V1NotifyHandler(self.sygnal)._tracing_enabled)
+        finally:
+            opentracing.tracer = old_global_tracer
+
     def test_exceptions_give_500(self):
         """
         Test that internal exceptions/errors lead to a 500 Internal Server Error